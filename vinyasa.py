@@ -1,11 +1,25 @@
+import contextlib
 import functools
 import hashlib
+import importlib
+import inspect
 import json
+import os
 import pickle
+import shutil
 import time
+import typing
 import warnings
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
-from tempfile import gettempdir
+from tempfile import gettempdir, mkstemp
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 import typer
 from rich import print
@@ -13,13 +27,50 @@ from rich import print
 CACHE = "vinyasa"
 GLOBAL_CONTEXT = {}
 
+# Hash used for cache keys. SHA-256 is the default as it needs no extra
+# dependency; "xxhash" is much faster for small inputs, and "blake3"
+# for large ones.
+HASH = os.environ.get("VINYASA_HASH", "sha256")
+
+# Report cache hits read from disk. Off by default to keep hits cheap.
+VERBOSE = bool(os.environ.get("VINYASA_VERBOSE"))
+
+# In-process LRU in front of the disk cache, keyed by cache key.
+# Only used by functions decorated with `memory=True`.
+MEMORY_CACHE_SIZE = 128
+memory_cache = OrderedDict()
+
+# File suffix of the cached results for each serializer.
+SERIALIZERS = {"pickle": ".pkl", "msgspec": ".msgpack"}
+BUFFER_SIZE = 1 << 20
+
+# Temporary files are written with this suffix before being published,
+# with the permissions `open` would give them (mkstemp uses 0600).
+TMP_SUFFIX = ".tmp"
+UMASK = os.umask(0)
+os.umask(UMASK)
+CACHE_FILE_MODE = 0o666 & ~UMASK
+
+# Cache files are sharded into subdirectories named after the first
+# two hex characters of their key; these are the ones known to exist.
+shard_dirs = set()
+
+# Comment declaring the scripts a script depends on, for parallel runs.
+DEPENDS_ON = "# vinyasa: depends_on="
+
+# Compiled scripts, keyed by path, modification time and size.
+compiled_scripts = {}
+
 app = typer.Typer(name="vinyasa", no_args_is_help=True, help="Vinyasa CLI")
 cache_dir = Path(gettempdir(), CACHE)
 cache_dir.mkdir(exist_ok=True)
 
 history_dir = Path.home() / ".vinyasa"
 history_dir.mkdir(exist_ok=True)
-history_file = history_dir / "history.json"
+history_file = history_dir / "history.jsonl"
+legacy_history_file = history_dir / "history.json"
+# History lines are written without whitespace to keep the file small.
+HISTORY_SEPARATORS = (",", ":")
 
 
 def save_full_script(scripts: list[str], full_script: str) -> None:
@@ -43,34 +94,305 @@ def save_full_script(scripts: list[str], full_script: str) -> None:
 
     print(f"Dumping full script to {full_script} ...")
     full_script_path = Path(full_script)
-    with open(full_script_path, "w") as full_file:
+    with open(full_script_path, "wb") as full_file:
         for script in scripts:
             script_path = resolve_script_path(script)
-            with open(script_path) as f:
-                full_file.write(f.read() + "\n\n")
+            with open(script_path, "rb") as f:
+                shutil.copyfileobj(f, full_file, BUFFER_SIZE)
+            full_file.write(b"\n\n")
 
     print(f"Full script dumped to {full_script_path}")
 
 
+def migrate_history(file) -> None:
+    """Convert the legacy `history.json` into the JSON Lines history.
+
+    Parameters
+    ----------
+    file : file object
+        The history, opened for appending and `locked`,
+        so that only one run migrates.
+    """
+    if not legacy_history_file.exists() or os.fstat(file.fileno()).st_size:
+        return
+
+    with open(legacy_history_file, "r") as legacy_file:
+        data = json.load(legacy_file)
+    for entry in data:
+        file.write(json.dumps(entry, separators=HISTORY_SEPARATORS) + "\n")
+    legacy_history_file.unlink()
+
+
+def load_history():
+    """Iterate over the history entries, oldest first."""
+    with open(history_file, "r") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+@contextlib.contextmanager
+def locked(file):
+    """Hold an exclusive lock on an open file, so runs write one at a time."""
+    if fcntl is not None:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield file
+        finally:
+            file.flush()
+            fcntl.flock(file, fcntl.LOCK_UN)
+        return
+
+    # msvcrt locks bytes from the current position: lock the first one.
+    file.seek(0)
+    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+    try:
+        yield file
+    finally:
+        file.flush()
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
 def save_history(scripts) -> None:
+    """Append a pipeline run to the history.
+
+    Notes
+    -----
+    The history is stored as JSON Lines, one run per line,
+    so saving a run never reads or rewrites previous runs.
+    The file is locked while writing, so concurrent runs
+    never interleave their lines.
+    """
     history_data = {
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
         "scripts": scripts,
     }
-    if history_file.exists():
-        with open(history_file, "r") as file:
-            data = json.load(file)
+    line = json.dumps(history_data, separators=HISTORY_SEPARATORS) + "\n"
+    with open(history_file, "a") as file, locked(file):
+        migrate_history(file)
+        file.write(line)
+
+
+def import_optional(name: str):
+    """Import an optional dependency, or point to the `fast` extra."""
+    try:
+        return importlib.import_module(name)
+    except ImportError as error:
+        raise ImportError(
+            f"{name} is not installed: pip install vinyasa[fast]"
+        ) from error
+
+
+def new_hash():
+    """Create an empty hash object for cache keys.
+
+    The algorithm is selected with the ``VINYASA_HASH``
+    environment variable: ``sha256`` (default), ``xxhash``
+    or ``blake3``.
+
+    Notes
+    -----
+    Switching the algorithm changes every cache key,
+    so results cached with the other algorithm are recomputed.
+    """
+    if HASH == "sha256":
+        return hashlib.sha256()
+
+    if HASH == "xxhash":
+        return import_optional("xxhash").xxh3_64()
+
+    if HASH == "blake3":
+        return import_optional("blake3").blake3()
+
+    raise ValueError(f"Unknown VINYASA_HASH: {HASH!r}")
+
+
+def remember(key, value) -> None:
+    """Store a value in the in-process cache, evicting the oldest entry."""
+    memory_cache[key] = value
+    # Tolerate concurrent evictions from other threads.
+    with contextlib.suppress(KeyError):
+        memory_cache.move_to_end(key)
+        while len(memory_cache) > MEMORY_CACHE_SIZE:
+            memory_cache.popitem(last=False)
+
+
+def dump_result(result, file, serializer: str) -> None:
+    if serializer == "msgspec":
+        file.write(import_optional("msgspec").msgpack.encode(result))
     else:
-        data = []
-    data.append(history_data)
-    with open(history_file, "w") as file:
-        json.dump(data, file, indent=4)
+        pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+
 
+def load_result(file, serializer: str, result_type=typing.Any):
+    if serializer == "msgspec":
+        msgpack = import_optional("msgspec").msgpack
+        return msgpack.decode(file.read(), type=result_type)
+    return pickle.load(file)
+
+
+def cache_file_path(key: int, suffix: str) -> Path:
+    name = f"{key:016x}"
+    return cache_dir / name[:2] / f"{name[2:]}{suffix}"
+
+
+def make_shard_dir(cache_file: Path) -> None:
+    shard_dir = cache_file.parent
+    if shard_dir not in shard_dirs:
+        shard_dir.mkdir(exist_ok=True)
+        shard_dirs.add(shard_dir)
+
+
+def read_cache_file(cache_file: Path, serializer: str, result_type):
+    """Read a result from the cache.
+
+    Raises `FileNotFoundError` if the result is not cached.
+    """
+    with open(cache_file, "rb", buffering=BUFFER_SIZE) as file:
+        return load_result(file, serializer, result_type)
 
-def cache(func):
+
+def write_cache_file(cache_file: Path, result, serializer: str) -> None:
+    """Atomically write a result to the cache.
+
+    The result is dumped to a unique temporary file which is then
+    renamed, so concurrent writers (processes or threads) never read
+    a partially written cache file. If another writer already
+    published the file, nothing is written.
+    """
+    if cache_file.exists():
+        return
+
+    make_shard_dir(cache_file)
+    fd, tmp_file = mkstemp(
+        suffix=TMP_SUFFIX, prefix=cache_file.name, dir=cache_file.parent
+    )
+    try:
+        with open(fd, "wb", buffering=BUFFER_SIZE) as file:
+            dump_result(result, file, serializer)
+        os.chmod(tmp_file, CACHE_FILE_MODE)
+        os.replace(tmp_file, cache_file)
+    except FileNotFoundError:
+        # `vinyasa clear` removed the temporary file: skip caching.
+        pass
+    except OSError:
+        # Publishing failed; fine as long as another writer succeeded.
+        if not cache_file.exists():
+            raise
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_file)
+
+
+def key_bytes(value) -> bytes:
+    """Encode an argument for the cache key.
+
+    Common scalars are encoded directly; anything else is pickled,
+    falling back to its `__repr__` if it cannot be pickled.
+    """
+    kind = type(value)
+    if kind in (int, float, bool):
+        return f"{kind.__name__}:{value}".encode()
+    if kind is str:
+        # surrogatepass accepts undecodable file names (os.fsdecode).
+        return b"s:" + value.encode("utf-8", "surrogatepass")
+    if kind is bytes:
+        return b"b:" + value
+
+    try:
+        return b"p:" + pickle.dumps(value, protocol=5)
+    except Exception:
+        # Unpicklable objects raise all sorts of errors from __reduce__.
+        return b"r:" + repr(value).encode("utf-8", "surrogatepass")
+
+
+def make_cached_call(func, serializer: str, memory: bool):
+    """Build the cached call shared by `cache` and `fast_cache`.
+
+    The returned ``cached_call(arguments, args, kwargs)`` hashes the
+    ``(name, value)`` pairs in `arguments` into the cache key and, on a
+    miss, computes the result with ``func(*args, **kwargs)``.
+    With `memory`, results are also kept in `memory_cache`.
+    """
+    if serializer not in SERIALIZERS:
+        raise ValueError(f"Unknown serializer: {serializer!r}")
+    suffix = SERIALIZERS[serializer]
+
+    # msgspec decodes into the annotated return type, so hits
+    # return the same types as the first call.
+    result_type = typing.Any
+    if serializer == "msgspec":
+        result_type = typing.get_type_hints(func).get("return", typing.Any)
+
+    # The name and bytecode never change between calls,
+    # so hash them once and only mix in the arguments per call.
+    base_hasher = new_hash()
+    base_hasher.update(func.__name__.encode())
+    base_hasher.update(func.__code__.co_code)
+
+    def cached_call(arguments, args, kwargs):
+        hasher = base_hasher.copy()
+        for name, value in arguments:
+            data = key_bytes(value)
+            hasher.update(name.encode())
+            hasher.update(len(data).to_bytes(8, "little"))
+            hasher.update(data)
+        # 64 bits are plenty for a local cache, and an int key
+        # hashes in constant time for the in-memory lookup.
+        key = int.from_bytes(hasher.digest()[:8], "big")
+        if memory:
+            # Another thread may evict the key at any point,
+            # in which case fall through to the disk cache.
+            try:
+                result = memory_cache[key]
+                memory_cache.move_to_end(key)
+            except KeyError:
+                pass
+            else:
+                return result
+
+        cache_file = cache_file_path(key, suffix)
+
+        try:
+            result = read_cache_file(cache_file, serializer, result_type)
+        except FileNotFoundError:
+            pass
+        else:
+            if VERBOSE:
+                print(f"({func.__name__}) Reading from cache: {cache_file}")
+            if memory:
+                remember(key, result)
+            return result
+
+        result = func(*args, **kwargs)
+        write_cache_file(cache_file, result, serializer)
+        if memory:
+            remember(key, result)
+        return result
+
+    return cached_call
+
+
+def cache(func=None, *, serializer: str = "pickle", memory: bool = False):
     """Cache the results of a function, based on its arguments and bytecode.
 
-    The arguments need to have a valid `__repr__` method.
+    The arguments need to be picklable, or else have a valid
+    `__repr__` method.
+
+    Parameters
+    ----------
+    serializer : str, optional
+        How results are stored on disk, by default "pickle".
+        Use "msgspec" for faster storage of simple results
+        (builtin types, dataclasses, ...). Requires `msgspec`.
+        Results are decoded into the function's return annotation;
+        without one, hits return msgpack types (dicts, lists, ...).
+    memory : bool, optional
+        Also keep results in memory (see `MEMORY_CACHE_SIZE`),
+        so repeated calls in the same process skip the disk,
+        by default False. Every hit then returns the same object,
+        so mutating a result changes it for later callers.
 
     Notes
     -----
@@ -84,24 +406,101 @@ def cache(func):
     or add a new statement, the function will be re-run.
     """
 
+    if func is None:
+        return functools.partial(cache, serializer=serializer, memory=memory)
+
+    cached_call = make_cached_call(func, serializer, memory)
+
+    # Arguments are bound to the signature, so that the same call
+    # spelled differently (positional, keyword, default) shares a key.
+    signature = inspect.signature(func)
+    var_keyword = next(
+        (
+            parameter.name
+            for parameter in signature.parameters.values()
+            if parameter.kind is parameter.VAR_KEYWORD
+        ),
+        None,
+    )
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        bytecode = func.__code__.co_code
-        key_data = f"{func.__name__}{args}{kwargs}{bytecode}"
-        key = hashlib.sha256(key_data.encode()).hexdigest()
-        cache_file = cache_dir / f"{key}.pkl"
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = bound.arguments
+        if var_keyword is not None:
+            arguments[var_keyword] = dict(
+                sorted(arguments[var_keyword].items())
+            )
+        return cached_call(arguments.items(), args, kwargs)
+
+    return wrapper
 
-        if cache_file.exists():
-            print(f"({func.__name__}) Reading from cache: {cache_file}")
-            with open(cache_file, "rb") as file:
-                return pickle.load(file)
 
-        result = func(*args, **kwargs)
-        with open(cache_file, "wb") as file:
-            pickle.dump(result, file)
-        return result
+def fast_cache(func=None, *, serializer: str = "pickle", memory: bool = False):
+    """Cache the results of a function, like `cache`, for hot functions.
 
-    return wrapper
+    The wrapper is generated with the same parameters as the function,
+    so each call skips building ``*args, **kwargs`` and binding them
+    to the signature. Keys and parameters are the same as with `cache`.
+
+    Functions taking ``*args`` or ``**kwargs`` are not supported.
+    """
+
+    if func is None:
+        return functools.partial(
+            fast_cache, serializer=serializer, memory=memory
+        )
+
+    namespace = {
+        "_vinyasa_cached_call": make_cached_call(func, serializer, memory),
+        "_vinyasa_no_kwargs": {},
+    }
+    parameters, arguments, positional, keywords = [], [], [], []
+    previous = None
+    for parameter in inspect.signature(func).parameters.values():
+        kind = parameter.kind
+        if kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+            raise TypeError(
+                "fast_cache does not support *args or **kwargs: "
+                f"{func.__qualname__}"
+            )
+        if previous is parameter.POSITIONAL_ONLY and kind is not previous:
+            parameters.append("/")
+        if kind is parameter.KEYWORD_ONLY and kind is not previous:
+            parameters.append("*")
+        previous = kind
+
+        name = parameter.name
+        if parameter.default is parameter.empty:
+            parameters.append(name)
+        else:
+            namespace[f"_vinyasa_default_{name}"] = parameter.default
+            parameters.append(f"{name}=_vinyasa_default_{name}")
+
+        arguments.append(f"({name!r}, {name}),")
+        if kind is parameter.KEYWORD_ONLY:
+            keywords.append(f"{name!r}: {name}")
+        else:
+            positional.append(f"{name},")
+    if previous is inspect.Parameter.POSITIONAL_ONLY:
+        parameters.append("/")
+
+    if keywords:
+        kwargs = "{" + ", ".join(keywords) + "}"
+    else:
+        kwargs = "_vinyasa_no_kwargs"
+
+    source = (
+        f"def wrapper({', '.join(parameters)}):\n"
+        f"    return _vinyasa_cached_call(\n"
+        f"        ({' '.join(arguments)}),\n"
+        f"        ({' '.join(positional)}),\n"
+        f"        {kwargs},\n"
+        f"    )\n"
+    )
+    exec(source, namespace)
+    return functools.wraps(func)(namespace["wrapper"])
 
 
 def resolve_script_path(script) -> Path:
@@ -111,16 +510,112 @@ def resolve_script_path(script) -> Path:
     return script_path
 
 
-def run_script(script: str) -> None:
+def run_script(script: str, context: dict = None) -> None:
+    """Run a script, by default in the namespace shared by the pipeline."""
+    if context is None:
+        context = GLOBAL_CONTEXT
+
     script_path = resolve_script_path(script)
     if not script_path.exists():
         print(f"Script not found: {script}")
         return
 
+    stat = script_path.stat()
+    key = (str(script_path), stat.st_mtime_ns, stat.st_size)
+    code = compiled_scripts.get(key)
+    if code is None:
+        code = compile(script_path.read_text(), script_path.name, "exec")
+        compiled_scripts[key] = code
+
+    exec(code, context)
+
+
+def run_isolated_script(script: str) -> None:
+    """Run a script in a fresh namespace, as done by parallel workers."""
+    warnings.filterwarnings("ignore")
+    run_script(script, context={})
+
+
+def read_dependencies(script: str) -> list[Path]:
+    """Read the scripts a script depends on.
+
+    Dependencies are declared with comment lines such as
+    ``# vinyasa: depends_on=load_data.py, preprocess.py``,
+    with paths relative to the directory of the declaring script.
+    """
+    script_path = resolve_script_path(script)
+    if not script_path.exists():
+        return []
+
+    dependencies = []
     with open(script_path) as f:
-        script_str = "\n".join(f.readlines())
-        code = compile(script_str, script_path.name, "exec")
-        exec(code, GLOBAL_CONTEXT)
+        for line in f:
+            if not line.startswith(DEPENDS_ON):
+                continue
+            for dependency in line[len(DEPENDS_ON) :].split(","):
+                if dependency.strip():
+                    dependency_path = script_path.parent / dependency.strip()
+                    dependencies.append(dependency_path.resolve())
+    return dependencies
+
+
+def run_parallel(scripts: list[str], jobs: int) -> None:
+    """Run scripts in worker processes, following their dependencies.
+
+    Parameters
+    ----------
+    scripts : list[str]
+        List of scripts to run. Each script may appear only once,
+        and may only depend on scripts in the list.
+    jobs : int
+        Number of worker processes.
+
+    Notes
+    -----
+    A script starts once every script it depends on (see
+    `read_dependencies`) has finished; scripts without pending
+    dependencies run concurrently. Each script runs in its own
+    namespace, so variables are not shared between scripts:
+    pass results along with `cache` instead.
+    """
+    paths = {
+        script: resolve_script_path(script).resolve() for script in scripts
+    }
+    in_pipeline = set(paths.values())
+    if len(in_pipeline) < len(scripts):
+        print("Scripts can only run once in parallel mode.")
+        raise typer.Exit(code=1)
+
+    pending = {}
+    for script in scripts:
+        pending[script] = set(read_dependencies(script))
+        unknown = pending[script] - in_pipeline
+        if unknown:
+            names = ", ".join(str(path) for path in sorted(unknown))
+            print(f"{script} depends on scripts not in the pipeline: {names}")
+            raise typer.Exit(code=1)
+    done = set()
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        while pending or running:
+            ready = [
+                script for script, needs in pending.items() if needs <= done
+            ]
+            if not ready and not running:
+                print(f"Circular dependencies between: {', '.join(pending)}")
+                raise typer.Exit(code=1)
+
+            for script in ready:
+                del pending[script]
+                future = executor.submit(run_isolated_script, script)
+                running[future] = script
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                script = running.pop(future)
+                future.result()
+                done.add(paths[script])
 
 
 @app.command(
@@ -136,6 +631,13 @@ def run(
         "--full-script",
         help="Dump full script to a file.",
     ),
+    jobs: int = typer.Option(
+        1,
+        "--parallel",
+        "-j",
+        help="Run independent scripts in N processes. "
+        "Order them with '# vinyasa: depends_on=script.py' comments.",
+    ),
 ):
     warnings.filterwarnings("ignore")
     save_history(scripts)
@@ -144,8 +646,11 @@ def run(
         save_full_script(scripts=scripts, full_script=full_script)
 
     start = time.time()
-    for script in scripts:
-        run_script(script)
+    if jobs > 1:
+        run_parallel(scripts=scripts, jobs=jobs)
+    else:
+        for script in scripts:
+            run_script(script)
     end = time.time()
 
     T = end - start
@@ -163,39 +668,42 @@ def history(
     ),
 ):
     if clear:
-        with open(history_file, "w") as file:
-            json.dump([], file)
+        with open(history_file, "a") as file, locked(file):
+            file.truncate(0)
+            legacy_history_file.unlink(missing_ok=True)
         print("History cleared.")
         return
 
-    if history_file.exists():
-        with open(history_file, "r") as file:
-            history_data = json.load(file)
-
-    else:
+    if not history_file.exists() and not legacy_history_file.exists():
         print("No history available.")
         return
 
-    if unique:
-        unique_runs = set(
-            [
-                "vinyasa run " + " ".join(entry["scripts"])
-                for entry in history_data
-            ]
-        )
+    with open(history_file, "a") as file, locked(file):
+        migrate_history(file)
 
-        for entry in unique_runs:
-            print(entry)
+    if unique:
+        seen = set()
+        unique_runs = []
+        for entry in load_history():
+            scripts = tuple(entry["scripts"])
+            if scripts in seen:
+                continue
+            seen.add(scripts)
+            unique_runs.append("vinyasa run " + " ".join(scripts))
+            print(unique_runs[-1])
 
         history_data = {
             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "scripts": list(unique_runs),
+            "scripts": unique_runs,
         }
 
     else:
-        for entry in history_data:
+        history_data = []
+        for entry in load_history():
             cli_call = "vinyasa run " + " ".join(entry["scripts"])
             print(f"{entry['timestamp']}: {cli_call}")
+            if dump:
+                history_data.append(entry)
 
     if dump:
         dump_path = Path(dump)
@@ -204,11 +712,26 @@ def history(
         print(f"History dumped to {dump_path}")
 
 
+def remove_cache_files(directory) -> None:
+    """Remove the cached results in a directory and its shards.
+
+    Temporary files left behind by interrupted writers are removed too.
+    Shard directories are kept, since running processes
+    remember them as created.
+    """
+    suffixes = (*SERIALIZERS.values(), TMP_SUFFIX)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                remove_cache_files(entry.path)
+            elif entry.name.endswith(suffixes):
+                os.unlink(entry.path)
+
+
 @app.command(help="Clear all cached function results.")
 def clear():
     print("Clearing cache...")
-    for cache_file in cache_dir.glob("*.pkl"):
-        cache_file.unlink()
+    remove_cache_files(cache_dir)
     print("Cache cleared.")
 
 